@@ -0,0 +1,188 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from core.palette import DITHER_MODES
+from core.constants import Q3_FPS, COMPRESS_LEVEL
+from core.profiling import report_path
+
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.tga', '.bmp')
+VIDEO_EXTS = ('.mp4', '.avi', '.mkv', '.mov')
+
+
+def collect_inputs(patterns: list[str]) -> list[str]:
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = sorted(os.listdir(pattern))
+            matches = [os.path.join(pattern, name) for name in names]
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+
+        for path in matches:
+            ext = os.path.splitext(path)[1].lower()
+            if os.path.isfile(path) and ext in IMAGE_EXTS + VIDEO_EXTS and path not in paths:
+                paths.append(path)
+    return paths
+
+
+def output_path(path: str, out_dir: str | None, keep_ext: bool = False) -> str:
+    ext = '.pk3' if os.path.splitext(path)[1].lower() in VIDEO_EXTS else '.cfg'
+    name = os.path.basename(path)
+    base = (name if keep_ext else os.path.splitext(name)[0]) + ext
+    return os.path.abspath(os.path.join(out_dir or os.path.dirname(path), base))
+
+
+def output_paths(paths: list[str], out_dir: str | None) -> dict[str, str]:
+    # a.png and a.jpg would both become a.cfg, inputs that clash keep their extension (a.png.cfg)
+    outputs = {path: output_path(path, out_dir) for path in paths}
+    counts = {}
+    for out in outputs.values():
+        counts[out] = counts.get(out, 0) + 1
+    for path, out in outputs.items():
+        if counts[out] > 1:
+            outputs[path] = output_path(path, out_dir, keep_ext=True)
+
+    # same-named files from different folders still clash with -o, so do names like a.png.cfg
+    seen = {}
+    inputs = {os.path.abspath(path) for path in paths}
+    for path, out in outputs.items():
+        if out in inputs:
+            raise ValueError(f'{path} would be overwritten by its own output')
+        if out in seen:
+            raise ValueError(f'{seen[out]} and {path} would both be saved as {out}')
+        seen[out] = path
+    return outputs
+
+
+def convert_file(path: str, out_path: str, options: dict) -> tuple[float, int]:
+    # runs in a worker process, imports stay here so the parent never loads cv2
+    start = time.perf_counter()
+
+    if os.path.splitext(path)[1].lower() in VIDEO_EXTS:
+        from core.video_loader import VideoLoader
+        from core.cfg_writer import PK3Writer
+
+        loader = VideoLoader(workers=options['threads'])
+        if not loader.load_video(path):
+            raise ValueError('Failed to load video')
+        loader.rd_lambda = options['rd_lambda']
+        loader.dither = options['dither']
+        loader.target_fps = options['game_fps'] / max(options['wait'], 1)
+        loader.start_time = options['start']
+        loader.end_time = options['end']
+
+        frames = loader.iter_frames(options['width'], options['height'])
+        writer = PK3Writer(frames, options['print_method'], options['wait'],
+                           merge_threshold=options['merge'] / 100, profile=loader.profile,
+                           compress_level=options['compress_level'], workers=options['threads'])
+        count = 0
+        for count in writer.save_pk3(out_path):
+            pass
+        if options['profile']:
+            writer.profile.save(report_path(out_path), frames=max(count - 1, 0))
+        return time.perf_counter() - start, max(count - 1, 0)
+
+    from core.image_loader import ImageLoader
+    from core.cfg_writer import CFGWriter
+
+    loader = ImageLoader()
+    loader.rd_lambda = options['rd_lambda']
+    loader.dither = options['dither']
+    if not loader.load_image(path, with_alpha=options['alpha']):
+        raise ValueError('Failed to load image')
+    loader.resize_image(options['width'], options['height'])
+
+    writer = CFGWriter(loader.indexed, options['print_method'])
+    writer.save_cfg(out_path, wait_time=options['wait'])
+    if options['profile']:
+        writer.profile.save(report_path(out_path), frames=1)
+    return time.perf_counter() - start, 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='main.py',
+        description='Convert images to .cfg and videos to .pk3 without the GUI.'
+    )
+    parser.add_argument('inputs', nargs='+', help='files, directories or glob patterns')
+    parser.add_argument('-o', '--output', help='output directory, next to the inputs by default')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='parallel processes')
+    parser.add_argument('--width', type=int, default=80)
+    parser.add_argument('--height', type=int, default=40)
+    parser.add_argument('--wait', type=int, default=5, help='wait between lines (images) or frames (videos)')
+    parser.add_argument('--print-method', choices=('say', 'echo'), default='say')
+    parser.add_argument('--alpha', action='store_true', help='keep the alpha channel of png/tga images')
+    parser.add_argument('--dither', choices=DITHER_MODES, default='none')
+    parser.add_argument('--rd-lambda', type=float, default=0.0)
+    parser.add_argument('--start', type=float, default=0.0, help='first second of the videos to export')
+    parser.add_argument('--end', type=float, default=None, help='last second of the videos to export')
+    parser.add_argument('--game-fps', type=float, default=Q3_FPS, help='com_maxfps the wait is counted in')
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=COMPRESS_LEVEL,
+                        metavar='0-9', help='zlib level of the pk3 entries, 0 stores them uncompressed')
+    parser.add_argument('--profile', action='store_true', help='write <output>.profile.json with stage timings')
+    parser.add_argument('--merge', type=float, default=0.0, help='merge video frames changing less than this %%')
+    return parser
+
+
+def main(argv: list[str]) -> int:
+    args = build_parser().parse_args(argv)
+
+    paths = collect_inputs(args.inputs)
+    if not paths:
+        print('No images or videos found', file=sys.stderr)
+        return 1
+
+    try:
+        outputs = output_paths(paths, args.output)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    jobs = max(1, min(args.jobs, len(paths)))
+    options = {
+        'width': args.width,
+        'height': args.height,
+        'wait': args.wait,
+        'print_method': args.print_method,
+        'alpha': args.alpha,
+        'dither': args.dither,
+        'rd_lambda': args.rd_lambda,
+        'merge': args.merge,
+        'profile': args.profile,
+        'compress_level': args.compress_level,
+        'start': args.start,
+        'end': args.end,
+        'game_fps': args.game_fps,
+        # share the cores between processes instead of every video loader taking all of them
+        'threads': max(1, (os.cpu_count() or 1) // jobs),
+    }
+
+    failed = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for path in paths:
+            out_path = outputs[path]
+            futures[pool.submit(convert_file, path, out_path, options)] = (path, out_path)
+
+        for future in as_completed(futures):
+            path, out_path = futures[future]
+            try:
+                seconds, frames = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'  FAILED  {path}: {e}')
+                continue
+            print(f'{seconds:8.2f}s  {frames:6d} frames  {path} -> {out_path}')
+
+    print(f'{len(paths) - failed}/{len(paths)} converted in {time.perf_counter() - start:.2f}s')
+    return 1 if failed else 0
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from PIL import Image
+
+from core.image_loader import ImageLoader
+from core.cfg_writer import CFGWriter, PK3Writer
+from core.indexed_video import IndexedVideo
+
+
+# console sizes the exports are measured at, and clip lengths for the video stages
+SIZES = ((40, 20), (80, 40), (100, 100))
+FRAME_COUNTS = (10, 60)
+
+# resolution of the synthetic sources, close to a typical picture / webcam clip
+SOURCE_SIZE = (640, 480)
+VIDEO_SIZE = (320, 240)
+
+# timings closer than this to the baseline are noise, whatever the ratio says
+MIN_DELTA = 0.002
+
+
+def make_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    # smooth gradients with noise, so runs of equal colour and colour changes both show up
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    rgb = rgb + rng.integers(-40, 40, size=rgb.shape)
+    return Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8), 'RGB')
+
+
+def make_video(path: str, frames: int, fps: float = 30.0) -> str:
+    import cv2
+
+    width, height = VIDEO_SIZE
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    base = np.array(make_image(width * 2, height))
+    for i in range(frames):
+        # a panning background with a moving block, every frame differs a little
+        shift = i * 4 % width
+        frame = np.ascontiguousarray(base[:, shift:shift + width, ::-1])
+        x = i * 7 % (width - 40)
+        frame[100:140, x:x + 40] = (0, 0, 255)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def measure(fn, repeat: int) -> dict:
+    fn()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # allocations are traced in a separate run, tracing slows everything down
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'min': min(times),
+        'median': float(np.median(times)),
+        'peak_kb': peak // 1024,
+    }
+
+
+def image_cases(tmp_dir: str):
+    source = make_image(*SOURCE_SIZE)
+    cfg_path = os.path.join(tmp_dir, 'bench.cfg')
+
+    for width, height in SIZES:
+        loader = ImageLoader()
+        loader.original_image = source.convert('RGBA')
+        loader.resize_image(width, height)
+        writer = CFGWriter(loader.indexed)
+
+        name = f'image {width}x{height}'
+        # defaults bind this iteration's values, the cases run after the loop is done
+        yield f'{name} quantize', lambda l=loader, w=width, h=height: l.resize_image(w, h)
+        yield f'{name} encode', lambda c=writer: c.encode(wait_time=5)
+        yield f'{name} save_cfg', lambda c=writer: c.save_cfg(cfg_path, wait_time=5)
+
+
+def video_cases(tmp_dir: str):
+    from core.video_loader import VideoLoader
+
+    pk3_path = os.path.join(tmp_dir, 'bench.pk3')
+
+    for count in FRAME_COUNTS:
+        video_path = make_video(os.path.join(tmp_dir, f'bench{count}.avi'), count)
+        loader = VideoLoader()
+        if not loader.load_video(video_path):
+            raise RuntimeError('OpenCV could not read the synthetic clip')
+
+        for width, height in SIZES:
+            # stored like the video tab stores a processed clip, with a transparent corner
+            # on the first frame so the clear pixel path is exported too
+            frames = IndexedVideo()
+            for frame in loader.iter_frames(width, height):
+                frames.append(frame)
+            corner = frames[0]
+            corner.paint((slice(0, height // 4), slice(0, width // 4)), None)
+            frames.frames[0] = corner.labels()
+
+            name = f'video {count}f {width}x{height}'
+            yield f'{name} process', lambda l=loader, w=width, h=height: list(l.iter_frames(w, h))
+            yield f'{name} save_pk3', lambda f=frames: list(PK3Writer(f, fps=5).save_pk3(pk3_path))
+
+
+def run(repeat: int, video: bool = True) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cases = list(image_cases(tmp_dir))
+        if video:
+            cases += video_cases(tmp_dir)
+
+        for name, fn in cases:
+            results[name] = measure(fn, repeat)
+            print(f'{name:32s} {results[name]["min"] * 1000:9.2f} ms {results[name]["peak_kb"]:8d} KB')
+
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, base in baseline['results'].items():
+        now = current['results'].get(name)
+        if now is None:
+            continue
+
+        if now['min'] > base['min'] * (1 + threshold) and now['min'] - base['min'] > MIN_DELTA:
+            regressions.append(f'{name}: {base["min"] * 1000:.2f} -> {now["min"] * 1000:.2f} ms')
+        if now['peak_kb'] > base['peak_kb'] * (1 + threshold) and now['peak_kb'] - base['peak_kb'] > 64:
+            regressions.append(f'{name}: {base["peak_kb"]} -> {now["peak_kb"]} KB peak')
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m core.benchmark',
+        description='Time quantization, encoding and pk3 export on synthetic inputs.'
+    )
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('-b', '--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-video', action='store_true', help='skip the stages that need OpenCV')
+    return parser
+
+
+def main(argv: list[str]) -> int:
+    args = build_parser().parse_args(argv)
+
+    current = run(max(1, args.repeat), video=not args.no_video)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(current, baseline, args.threshold)
+    for line in regressions:
+        print(f'  SLOWER  {line}')
+    print(f'{len(regressions)} regressions against {args.baseline}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
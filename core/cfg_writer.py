@@ -1,109 +1,346 @@
 import os
+import sys
+import time
+import zlib
+import hashlib
 import numpy as np
 import zipfile
-from scipy.spatial import cKDTree
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Iterable
+from PIL import Image
 
-from core.image_loader import PALLETE
+from core.constants import COMPRESS_LEVEL
+from core.palette import PALLETE, color_changes
+from core.indexed_image import IndexedImage
+from core.indexed_video import IndexedVideo
+from core.profiling import Profile
 
 
 OUTPATH = './temp'
 
+# "Acknowledge" (U+0006) is drawn as a solid block by the Q3 console
+GLYPH = 0x06
+KEY_BYTES = np.frombuffer(''.join(PALLETE).encode('ascii'), dtype=np.uint8)
+
+
+def encode_rows(image: IndexedImage, print_method: str = 'say') -> list[bytes]:
+    indices = image.indices
+    h, w = indices.shape
+    change = color_changes(indices, image.opaque)
+
+    # every pixel is '^', key, glyph; drop the code bytes where the colour is unchanged
+    buf = np.empty((h, w, 3), dtype=np.uint8)
+    buf[:, :, 0] = ord('^')
+    buf[:, :, 1] = KEY_BYTES[indices]
+    buf[:, :, 2] = np.where(image.opaque, GLYPH, ord(' '))
+
+    keep = np.empty((h, w, 3), dtype=bool)
+    keep[:, :, 0] = change
+    keep[:, :, 1] = change
+    keep[:, :, 2] = True
+
+    data = buf[keep].tobytes()
+    ends = np.cumsum(keep.sum(axis=(1, 2))).tolist()
+    
+    prefix = f'{print_method} "'.encode()
+    rows = []
+    start = 0
+    for end in ends:
+        rows.append(prefix + data[start:end] + b'"')
+        start = end
+    return rows
+
+
+def _deflate(data: bytes, level: int, profile: Profile) -> tuple[bytes, int]:
+    # raw deflate stream as zip stores it; zlib releases the GIL, so pool threads run in parallel
+    with profile.stage('compress'):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(), zlib.crc32(data)
+
+
+def raw_entries_supported(pk3: zipfile.ZipFile) -> bool:
+    # write_raw_entry leans on ZipFile internals, only trusted where ZipFile.mkdir uses the same ones
+    return sys.version_info >= (3, 11) and hasattr(zipfile.ZipInfo, 'FileHeader') \
+        and all(hasattr(pk3, name) for name in ('_lock', '_writecheck', '_didModify', 'fp', 'start_dir'))
+
+
+def write_raw_entry(pk3: zipfile.ZipFile, name: str, data: bytes, compressed: bytes, crc: int) -> None:
+    # adds an entry deflated elsewhere; zipfile has no public call for it, so these are
+    # the steps ZipFile.mkdir takes for an entry whose size and CRC are known up front
+    zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = crc
+
+    with pk3._lock:
+        zinfo.header_offset = pk3.fp.tell()
+        pk3._writecheck(zinfo)
+        pk3._didModify = True
+        pk3.fp.write(zinfo.FileHeader(False))
+        pk3.fp.write(compressed)
+        pk3.filelist.append(zinfo)
+        pk3.NameToInfo[zinfo.filename] = zinfo
+        pk3.start_dir = pk3.fp.tell()
+
+
+class RowCache:
+    # encoded lines of earlier exports, keyed by print method and the row's pixels.
+    # rows are encoded independently, so after an edit only the touched rows are redone
+    def __init__(self, max_rows: int = 4096):
+        self.max_rows = max_rows
+        self._rows = OrderedDict()
+        # rows encoded by the last call
+        self.misses = 0
+
+
+    def encode_rows(self, image: IndexedImage, print_method: str = 'say') -> list[bytes]:
+        keys = [(print_method, indices.tobytes(), opaque.tobytes())
+                for indices, opaque in zip(image.indices, image.opaque)]
+
+        missing = [y for y, key in enumerate(keys) if key not in self._rows]
+        self.misses = len(missing)
+        if missing:
+            changed = IndexedImage(image.indices[missing], image.opaque[missing])
+            for y, row in zip(missing, encode_rows(changed, print_method)):
+                self._rows[keys[y]] = row
+
+        rows = []
+        for key in keys:
+            self._rows.move_to_end(key)
+            rows.append(self._rows[key])
+
+        while len(self._rows) > self.max_rows:
+            self._rows.popitem(last=False)
+        return rows
+
 
 class CFGWriter:
-    def __init__(self, image, print_method='say'):
+    def __init__(self, image: IndexedImage, print_method='say', cache: RowCache | None = None):
         if image is None:
             raise ValueError('Image is None')
+        if isinstance(image, Image.Image):
+            image = IndexedImage.from_image(image)
         self.image = image
         self.print_method = print_method
+        self.cache = cache
+        self.profile = Profile()
         
         
-    def save_cfg(self, output_path: str = OUTPATH, wait_time: int = 6, fps: int = None, next_frame: str = None):
-        keys = list(PALLETE.keys())
-        colors = np.array([PALLETE[k] for k in keys], dtype=np.uint8)
+    def encode(self, wait_time: int = 6, fps: int = None, next_frame: str = None) -> bytes:
+        wait_line = f'wait {wait_time}'.encode() if wait_time else None
 
-        img_np = np.array(self.image.convert('RGBA'))
-        h, w, _ = img_np.shape
-        
-        rgb_pixels = img_np[:, :, :3].reshape(-1, 3)
-        alpha = img_np[:, :, 3].reshape(-1)
-        
-        tree = cKDTree(colors)
-        _, indices = tree.query(rgb_pixels)
+        if self.cache is not None:
+            rows = self.cache.encode_rows(self.image, self.print_method)
+        else:
+            rows = encode_rows(self.image, self.print_method)
 
-        char_map = []
-        for i, a in enumerate(alpha):
-            if a == 0:
-                char_map.append(' ')
-            else:
-                char_map.append(keys[indices[i]])
-
-        char_map = np.array(char_map).reshape((h, w))
-        
         lines = []
-        for y in range(h):
-            line = f'{self.print_method} "'
-            last_char = None
-            for x in range(w):
-                char = char_map[y][x]
-                if char == ' ':
-                    line += ' '
-                elif last_char != char:
-                    line += f'^{char}'
-                    last_char = char
-                else:
-                    line += ''
-            line += '"'
-            lines.append(line)
-            if wait_time:
-                lines.append(f'wait {wait_time}')
+        for row in rows:
+            lines.append(row)
+            if wait_line:
+                lines.append(wait_line)
         
         # for video
         if fps:
-            lines.append(f'wait {fps}')
+            lines.append(f'wait {fps}'.encode())
         if next_frame is not None:
-            lines.append(f'exec {next_frame}')
+            lines.append(f'exec {next_frame}'.encode())
+
+        return b'\n'.join(lines)
 
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w') as f:
-            f.write('\n'.join(lines))
+
+    def save_cfg(self, output_path: str = OUTPATH, wait_time: int = 6, fps: int = None, next_frame: str = None):
+        with self.profile.stage('encode'):
+            data = self.encode(wait_time=wait_time, fps=fps, next_frame=next_frame)
+
+        with self.profile.stage('write'):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'w') as f:
+                f.write(data.decode())
             
             
 class PK3Writer:
-    def __init__(self, frames: list, print_method='say', fps=6):
+    def __init__(self, frames: Iterable[IndexedImage] | IndexedVideo, print_method='say', fps=6, dedup: bool = True,
+                 merge_threshold: float = 0.0, profile: Profile | None = None,
+                 compress_level: int = COMPRESS_LEVEL, workers: int | None = None):
         self.frames = frames
         self.print_method = print_method
         self.fps = fps
+        self.dedup = dedup
+        # share of changed pixels below which a frame only extends the previous frame's wait
+        self.merge_threshold = merge_threshold
+        # pass the VideoLoader's profile to see decoding and export side by side
+        self.profile = profile or Profile()
+
+        # entries are deflated on a thread pool and written in order, level 0 stores them
+        self.compress_level = compress_level
+        self.workers = workers or os.cpu_count() or 1
         
         
     def save_pk3(self, output_path: str):
-        os.makedirs(OUTPATH, exist_ok=True)
-        
+        # frames may be a generator: each one is encoded and written into the
+        # archive as soon as it arrives, nothing touches the disk besides the pk3
         base_name = os.path.splitext(os.path.basename(output_path))[0]
-        frame_files = []
+
+        # digest of every frame body -> shared body cfg, None until the body repeats
+        self._bodies = {}
+        self._shared_count = 0
+        # digests used by more than one frame, only known up front for a processed clip
+        self._shared = None
+
+        # entries handed to the pool, waiting to be written in order
+        self._pending = deque()
+
+        compression = zipfile.ZIP_DEFLATED if self.compress_level else zipfile.ZIP_STORED
+        with zipfile.ZipFile(output_path, 'w', compression, compresslevel=self.compress_level or None) as pk3:
+            # stored entries need no pool; without the zipfile internals writestr deflates in line
+            parallel = self.compress_level > 0 and raw_entries_supported(pk3)
+            with ThreadPoolExecutor(max_workers=self.workers) if parallel else nullcontext() as pool:
+                self._pool = pool
+                yield from self._write_pk3(pk3, base_name)
+
+
+    def _write_pk3(self, pk3: zipfile.ZipFile, base_name: str):
+        if self.dedup and isinstance(self.frames, IndexedVideo):
+            # the whole clip is in memory: the runs are found from the labels first, then every
+            # body used more than once is stored a single time and all of its frames exec it
+            runs = self._clip_runs()
+            counts = Counter(digest for _, digest, _ in runs)
+            self._shared = {digest for digest, count in counts.items() if count > 1}
+
+            for idx, (first, digest, repeats) in enumerate(runs, start=1):
+                with self.profile.stage('encode'):
+                    body = CFGWriter(image=self.frames[first], print_method=self.print_method).encode(wait_time=0)
+                with self.profile.stage('write'):
+                    self._write_frame(pk3, base_name, idx, body, digest, repeats, is_last=idx == len(runs))
+                # progress counts source frames, like the streamed path
+                yield first + repeats + 1
+        else:
+            written = [0]
+
+            def write_run(frame, body, digest, repeats, is_last):
+                written[0] += 1
+                with self.profile.stage('write'):
+                    self._write_frame(pk3, base_name, written[0], body, digest, repeats, is_last)
+
+            yield from self._runs(write_run)
+
+        with self.profile.stage('write'):
+            self._flush(pk3)
+
+        # Start cfg
+        pk3.writestr(f'start_{base_name}.cfg', f'exec {base_name}_frame1.cfg\n')
+
+
+    def _clip_runs(self) -> list[tuple[int, bytes, int]]:
+        # (first frame, digest, repeats) of every run of a processed clip; equal labels give
+        # equal bodies, so the labels are hashed and nothing gets encoded here
+        labels = self.frames.frames
+        same = self.frames.repeats()
+        size = max(labels[0].size, 1) if len(labels) else 1
+
+        runs = []
+        for idx in range(len(labels)):
+            if runs and same[idx]:
+                runs[-1][2] += 1
+                continue
+
+            # compared with the frame on screen, as in _runs
+            if runs and self.merge_threshold > 0:
+                with self.profile.stage('merge'):
+                    changed = np.count_nonzero(labels[runs[-1][0]] != labels[idx]) / size
+                if changed < self.merge_threshold:
+                    runs[-1][2] += 1
+                    continue
+
+            with self.profile.stage('encode'):
+                digest = hashlib.blake2b(labels[idx].tobytes(), digest_size=16).digest()
+            if runs and runs[-1][1] == digest:
+                runs[-1][2] += 1
+            else:
+                runs.append([idx, digest, 1])
+        return [tuple(run) for run in runs]
+
+
+    def _runs(self, on_run):
+        # groups the frames into runs of one picture held for `repeats` frame times,
+        # hands each finished run to on_run and yields progress like save_pk3
+        # [frame, body, digest, repeats] of the run waiting to be handed over
+        run = None
 
         for idx, frame in enumerate(self.frames, start=1):
-            frame_name = f'{base_name}_frame{idx}.cfg'
-            frame_path = os.path.join(OUTPATH, frame_name)
+            # compared with the frame on screen rather than the previous one,
+            # so slow changes still add up and eventually start a new frame
+            if run is not None and self.merge_threshold > 0:
+                with self.profile.stage('merge'):
+                    merged = run[0].difference(frame) < self.merge_threshold
+                if merged:
+                    run[3] += 1
+                    yield idx + 1
+                    continue
+
+            with self.profile.stage('encode'):
+                body = CFGWriter(image=frame, print_method=self.print_method).encode(wait_time=0)
+                digest = hashlib.blake2b(body, digest_size=16).digest()
+
+            # identical consecutive frames just make the previous frame wait longer
+            if run is not None and self.dedup and run[2] == digest:
+                run[3] += 1
+            else:
+                if run is not None:
+                    on_run(*run, is_last=False)
+                run = [frame, body, digest, 1]
 
-            next_frame = f'{base_name}_frame{idx+1}.cfg'
-            if idx >= len(self.frames):
-                next_frame = None                 
-            
-            frame_cfg = CFGWriter(image=frame, print_method=self.print_method)
-            frame_cfg.save_cfg(output_path=frame_path, wait_time=0, fps=self.fps, next_frame=next_frame)
-            frame_files.append(frame_path)
-            
             yield idx + 1
-            
-            
 
-        # Start cfg
-        start_cfg_name = f'start_{base_name}.cfg'
-        start_cfg_path = os.path.join(OUTPATH, start_cfg_name)
-        with open(start_cfg_path, 'w') as f:
-            f.write(f'exec {base_name}_frame1.cfg\n')
-        frame_files.append(start_cfg_path)
-
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as pk3:
-            for file_path in frame_files:
-                pk3.write(file_path, os.path.basename(file_path))
\ No newline at end of file
+        if run is not None:
+            on_run(*run, is_last=True)
+
+
+    def _write_frame(self, pk3: zipfile.ZipFile, base_name: str, idx: int, body: bytes, digest: bytes, repeats: int, is_last: bool):
+        if self._shared is not None:
+            shared = digest in self._shared
+        else:
+            # streamed frames can't be counted ahead: the first frame keeps its body inline
+            # and only the repeats exec a shared copy, so such a body is stored twice
+            shared = self.dedup and digest in self._bodies
+            if not shared:
+                self._bodies[digest] = None
+
+        if shared:
+            # body stored once and exec'd from a small stub
+            shared_name = self._bodies.get(digest)
+            if shared_name is None:
+                self._shared_count += 1
+                shared_name = f'{base_name}_body{self._shared_count}.cfg'
+                self._bodies[digest] = shared_name
+                self._add(pk3, shared_name, body)
+            body = f'exec {shared_name}'.encode()
+
+        lines = [body]
+        if self.fps:
+            lines.append(f'wait {self.fps * repeats}'.encode())
+        if not is_last:
+            lines.append(f'exec {base_name}_frame{idx+1}.cfg'.encode())
+
+        self._add(pk3, f'{base_name}_frame{idx}.cfg', b'\n'.join(lines))
+
+
+    def _add(self, pk3: zipfile.ZipFile, name: str, data: bytes):
+        if self._pool is None:
+            pk3.writestr(name, data)
+            return
+
+        self._pending.append((name, data, self._pool.submit(_deflate, data, self.compress_level, self.profile)))
+        # a few entries per worker keep the pool busy without holding the whole clip in memory
+        self._flush(pk3, keep=self.workers * 4)
+
+
+    def _flush(self, pk3: zipfile.ZipFile, keep: int = 0):
+        while len(self._pending) > keep:
+            name, data, future = self._pending.popleft()
+            write_raw_entry(pk3, name, data, *future.result())
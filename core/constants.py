@@ -0,0 +1,8 @@
+# shared by the writers and the front ends, kept apart so the GUI can read them
+# without importing the writers
+
+# com_maxfps the in-game `wait` values are counted in
+Q3_FPS = 125
+
+# zlib level of pk3 entries, 0 stores them uncompressed
+COMPRESS_LEVEL = 6
@@ -0,0 +1,105 @@
+import numpy as np
+from collections import deque
+
+from core.indexed_image import IndexedImage
+
+
+# bytes kept per changed pixel: position, old/new index, old/new opacity
+BYTES_PER_PIXEL = 8
+
+
+class EditHistory:
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        # every entry is (shape, positions, old indices, old opaque, new indices, new opaque)
+        self._undo = deque()
+        self._redo = []
+        self._size = 0
+
+        # flat positions and old values touched by the stroke in progress
+        self._pending: list[tuple[np.ndarray, np.ndarray, np.ndarray]] | None = None
+
+
+    def clear(self) -> None:
+        self._undo.clear()
+        self._redo.clear()
+        self._size = 0
+        self._pending = None
+
+
+    def begin(self) -> None:
+        self._pending = []
+
+
+    def record(self, image: IndexedImage, ys, xs) -> None:
+        # call before painting (ys, xs), only the first value of a pixel in a stroke is kept
+        if self._pending is None:
+            self.begin()
+        pos = np.ravel_multi_index((np.atleast_1d(ys), np.atleast_1d(xs)), image.indices.shape)
+        self._pending.append((pos, image.indices.flat[pos], image.opaque.flat[pos]))
+
+
+    def commit(self, image: IndexedImage) -> None:
+        pending, self._pending = self._pending, None
+        if not pending:
+            return
+
+        pos = np.concatenate([p[0] for p in pending])
+        old_idx = np.concatenate([p[1] for p in pending])
+        old_op = np.concatenate([p[2] for p in pending])
+
+        pos, first = np.unique(pos, return_index=True)
+        old_idx, old_op = old_idx[first], old_op[first]
+        new_idx, new_op = image.indices.flat[pos], image.opaque.flat[pos]
+
+        # pixels painted back to what they were are not worth keeping
+        changed = (old_op != new_op) | (new_op & (old_idx != new_idx))
+        if not changed.any():
+            return
+
+        entry = (image.indices.shape, pos[changed].astype(np.int32),
+                 old_idx[changed], old_op[changed], new_idx[changed], new_op[changed])
+        self._undo.append(entry)
+        self._size += self._entry_size(entry)
+        self._redo.clear()
+
+        # evict the oldest strokes first, but always keep the latest one
+        while self._size > self.max_bytes and len(self._undo) > 1:
+            self._size -= self._entry_size(self._undo.popleft())
+
+
+    def undo(self, image: IndexedImage):
+        if not self._undo:
+            return None
+        entry = self._undo.pop()
+        self._size -= self._entry_size(entry)
+        self._redo.append(entry)
+        return self._apply(image, entry, old=True)
+
+
+    def redo(self, image: IndexedImage):
+        if not self._redo:
+            return None
+        entry = self._redo.pop()
+        self._undo.append(entry)
+        self._size += self._entry_size(entry)
+        return self._apply(image, entry, old=False)
+
+
+    def _entry_size(self, entry) -> int:
+        return len(entry[1]) * BYTES_PER_PIXEL
+
+
+    def _apply(self, image: IndexedImage, entry, old: bool):
+        # returns the (x0, y0, x1, y1) box that changed
+        shape, pos, old_idx, old_op, new_idx, new_op = entry
+        if shape != image.indices.shape:
+            self.clear()
+            return None
+
+        image.indices.flat[pos] = old_idx if old else new_idx
+        image.opaque.flat[pos] = old_op if old else new_op
+
+        ys, xs = np.unravel_index(pos, shape)
+        return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
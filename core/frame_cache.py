@@ -0,0 +1,111 @@
+import os
+import hashlib
+import cv2
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'q3_console_painter', 'frames')
+# disk space all cached clips may take together, the oldest ones go first
+CACHE_LIMIT = 4 * 1024 ** 3
+
+# longest side decoded frames are shrunk to before processing, cached or not, so the
+# video tab and the batch CLI give the same output; exports are at most 100 wide
+WORK_SIDE = 256
+
+# bytes hashed from each end of the file, hashing whole clips would take longer than a decode
+HASH_SAMPLE = 1024 * 1024
+
+
+def file_key(path: str) -> str:
+    stat = os.stat(path)
+    digest = hashlib.blake2b(f'{stat.st_size}:{stat.st_mtime_ns}'.encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE))
+        if stat.st_size > HASH_SAMPLE:
+            f.seek(max(HASH_SAMPLE, stat.st_size - HASH_SAMPLE))
+            digest.update(f.read(HASH_SAMPLE))
+    return digest.hexdigest()
+
+
+def work_size(width: int, height: int, max_side: int = WORK_SIDE) -> tuple[int, int]:
+    scale = min(1.0, max_side / max(width, height, 1))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def shrink(frame: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    if (frame.shape[1], frame.shape[0]) == size:
+        return frame
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def trim_cache(cache_dir: str, limit: int) -> None:
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        stat = os.stat(path)
+        # frame files are sparse, count the blocks actually written
+        entries.append((stat.st_mtime, getattr(stat, 'st_blocks', 0) * 512 or stat.st_size, path))
+
+    used = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if used <= limit:
+            break
+        os.remove(path)
+        used -= size
+
+
+class FrameCache:
+    # decoded BGR frames of one clip at working resolution, in a memory-mapped .npy on disk;
+    # frames are stored as they get decoded, so any range / frame rate fills it up over time
+    def __init__(self, video_path: str, frame_count: int, width: int, height: int,
+                 cache_dir: str = CACHE_DIR, max_side: int = WORK_SIDE):
+        self.width, self.height = work_size(width, height, max_side)
+
+        # without sparse files (NTFS) the whole array is allocated up front
+        size = frame_count * self.width * self.height * 3
+        if size > CACHE_LIMIT:
+            raise ValueError(f'{size // 1024 ** 2} MB of frames is over the cache limit')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        base = os.path.join(cache_dir, f'{file_key(video_path)}_{self.width}x{self.height}')
+        shape = (frame_count, self.height, self.width, 3)
+
+        data_path, filled_path = base + '.npy', base + '_filled.npy'
+        if os.path.exists(data_path) and os.path.exists(filled_path):
+            self.frames = open_memmap(data_path, mode='r+')
+            self.filled = open_memmap(filled_path, mode='r+')
+            if self.frames.shape != shape:
+                raise ValueError('Cached frames do not match the clip')
+        else:
+            # room for the new clip at full size is made before it is created
+            trim_cache(cache_dir, CACHE_LIMIT - size)
+            self.frames = open_memmap(data_path, mode='w+', dtype=np.uint8, shape=shape)
+            # written last, a half created cache is never mistaken for a valid one
+            self.filled = open_memmap(filled_path, mode='w+', dtype=bool, shape=(frame_count,))
+
+
+    def __len__(self) -> int:
+        return len(self.filled)
+
+
+    def has(self, idx: int) -> bool:
+        return idx < len(self.filled) and bool(self.filled[idx])
+
+
+    def get(self, idx: int) -> np.ndarray:
+        return np.array(self.frames[idx])
+
+
+    def put(self, idx: int, frame: np.ndarray) -> np.ndarray:
+        # returns the working size frame, callers use it so hits and misses give the same output
+        small = shrink(frame, (self.width, self.height))
+        if idx < len(self.filled):
+            self.frames[idx] = small
+            self.filled[idx] = True
+        return small
+
+
+    def flush(self) -> None:
+        self.frames.flush()
+        self.filled.flush()
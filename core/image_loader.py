@@ -1,39 +1,9 @@
 import os
 import numpy as np
-from scipy.spatial import cKDTree
 from PIL import Image
 
-
-PALLETE = {
-    'a': (255, 0, 0),
-    'b': (255, 92, 0),
-    'c': (255, 149, 0),
-    'd': (255, 200, 0),
-    'e': (255, 255, 0),
-    'f': (200, 255, 0),
-    'g': (149, 255, 0),
-    'h': (92, 255, 0),
-    'i': (0, 255, 0),
-    'j': (0, 255, 92),
-    'k': (0, 255, 149),
-    'l': (0, 255, 200),
-    'm': (0, 255, 255),
-    'n': (0, 200, 255),
-    'o': (0, 149, 255),
-    'p': (0, 92, 255),
-    'q': (0, 0, 255),
-    'r': (92, 0, 255),
-    's': (149, 0, 255),
-    't': (200, 0, 255),
-    'u': (255, 0, 255),
-    'v': (255, 0, 200),
-    'w': (255, 0, 149),
-    'x': (255, 0, 92),
-    'y': (255, 255, 255),
-    'z': (172, 172, 255),
-    '9': (149, 149, 149),
-    '0': (0, 0, 0),
-}
+from core.palette import PALLETE, color_changes, quantization_error
+from core.indexed_image import IndexedImage
 
 
 class ImageLoader:
@@ -42,7 +12,13 @@ class ImageLoader:
         self.height = height
         
         self.original_image = Image.new('RGBA', size=(width, height), color=(255, 255, 255, 0))
-        self.edited_image = None
+        self.indexed: IndexedImage | None = None
+
+        # > 0 trades colour accuracy for fewer '^x' codes, see quantize_rd
+        self.rd_lambda = 0.0
+        self.rd_report: dict | None = None
+        # one of palette.DITHER_MODES, ignored when rd_lambda is set
+        self.dither = 'none'
         
         self.quantize_image()
 
@@ -66,8 +42,8 @@ class ImageLoader:
 
             self.original_image = img
             self.width, self.height = img.size
-            self.edited_image = img.copy()
-            self.quantize_image()
+            # callers resize right after loading, dithering and the RD pass only run at the export size
+            self.quantize_image(preview=True)
             
             return True
         except Exception as e:
@@ -76,32 +52,40 @@ class ImageLoader:
 
 
     def resize_image(self, width: int, height: int) -> None:
-        self.edited_image = self.original_image.copy().resize((width, height), Image.Resampling.NEAREST)
-        self.width, self.height = self.edited_image.size
-        self.quantize_image()
+        resized = self.original_image.resize((width, height), Image.Resampling.NEAREST)
+        self.width, self.height = resized.size
+        self.quantize_image(resized)
     
 
-    def quantize_image(self) -> None:
-        if self.edited_image is None:
+    def quantize_image(self, image: Image.Image | None = None, preview: bool = False) -> None:
+        if image is None:
             if self.original_image is None:
                 raise ValueError('Image not loaded')
-            self.edited_image = self.original_image.copy()
-
-        img = self.edited_image.convert('RGBA')
-        img_np = np.array(img)
-
-        rgb = img_np[:, :, :3]
-        alpha = img_np[:, :, 3]
-
-        keys = list(PALLETE.keys())
-        colors = np.array([PALLETE[k] for k in keys], dtype=np.uint8)
-
-        h, w, _ = rgb.shape
-        pixels = rgb.reshape(-1, 3)
-
-        tree = cKDTree(colors)
-        _, indices = tree.query(pixels)
-        new_rgb = colors[indices].reshape((h, w, 3))
-
-        result = np.dstack((new_rgb, alpha))
-        self.edited_image = Image.fromarray(result, 'RGBA')
+            image = self.original_image
+
+        self.quantize_array(np.array(image.convert('RGBA')), preview)
+
+
+    def quantize_array(self, img_np: np.ndarray, preview: bool = False) -> None:
+        # RGB or RGBA uint8 array, lets callers skip the PIL round-trip;
+        # a preview skips dithering, the RD pass and its report
+        self.indexed = IndexedImage.from_array(img_np, dither='none' if preview else self.dither)
+        self.rd_report = None
+
+        if self.rd_lambda > 0 and not preview:
+            plain = self.indexed
+            self.indexed = IndexedImage.from_array(img_np, rd_lambda=self.rd_lambda)
+            self.rd_report = {
+                'bytes_saved': 2 * int(color_changes(plain.indices, plain.opaque).sum()
+                                       - color_changes(self.indexed.indices, self.indexed.opaque).sum()),
+                'error_added': quantization_error(img_np, self.indexed.indices, self.indexed.opaque)
+                               - quantization_error(img_np, plain.indices, plain.opaque),
+            }
+
+
+    @property
+    def edited_image(self) -> Image.Image | None:
+        # display only, exports work on self.indexed
+        if self.indexed is None:
+            return None
+        return self.indexed.to_image()
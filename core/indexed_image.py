@@ -0,0 +1,77 @@
+import numpy as np
+from PIL import Image
+
+from core.palette import COLORS, quantize, quantize_rd, dither_bayer, dither_diffusion
+
+
+# Label used for transparent pixels by IndexedImage.labels()
+TRANSPARENT = 255
+
+
+class IndexedImage:
+    def __init__(self, indices: np.ndarray, opaque: np.ndarray | None = None):
+        self.indices = np.ascontiguousarray(indices, dtype=np.uint8)
+        if opaque is None:
+            opaque = np.ones(self.indices.shape, dtype=bool)
+        self.opaque = np.ascontiguousarray(opaque, dtype=bool)
+
+
+    @classmethod
+    def from_array(cls, img_np: np.ndarray, rd_lambda: float = 0.0, dither: str = 'none') -> 'IndexedImage':
+        if img_np.shape[2] == 4:
+            opaque = img_np[:, :, 3] != 0
+        else:
+            opaque = np.ones(img_np.shape[:2], dtype=bool)
+
+        if rd_lambda > 0:
+            return cls(quantize_rd(img_np, opaque, rd_lambda), opaque)
+        if dither == 'bayer':
+            return cls(dither_bayer(img_np), opaque)
+        if dither == 'diffusion':
+            return cls(dither_diffusion(img_np, opaque), opaque)
+        return cls(quantize(img_np), opaque)
+
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> 'IndexedImage':
+        return cls.from_array(np.array(image.convert('RGBA')))
+
+
+    @property
+    def width(self) -> int:
+        return self.indices.shape[1]
+
+
+    @property
+    def height(self) -> int:
+        return self.indices.shape[0]
+
+
+    def copy(self) -> 'IndexedImage':
+        return IndexedImage(self.indices.copy(), self.opaque.copy())
+
+
+    def labels(self) -> np.ndarray:
+        return np.where(self.opaque, self.indices, TRANSPARENT).astype(np.uint8)
+
+
+    def difference(self, other: 'IndexedImage') -> float:
+        # share of pixels that changed colour or transparency
+        if self.indices.shape != other.indices.shape:
+            return 1.0
+        return float(np.count_nonzero(self.labels() != other.labels())) / max(self.indices.size, 1)
+
+
+    def paint(self, where, color: int | None) -> None:
+        if color is None:
+            self.opaque[where] = False
+        else:
+            self.indices[where] = color
+            self.opaque[where] = True
+
+
+    def to_image(self) -> Image.Image:
+        rgba = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        rgba[:, :, :3] = COLORS[self.indices]
+        rgba[:, :, 3] = self.opaque * np.uint8(255)
+        return Image.fromarray(rgba, 'RGBA')
@@ -0,0 +1,81 @@
+import numpy as np
+
+from core.indexed_image import IndexedImage, TRANSPARENT
+
+
+class IndexedVideo:
+    # processed clip as one (frames, h, w) uint8 array of palette labels, TRANSPARENT marks
+    # clear pixels; 1 byte per pixel and no per-frame objects until a frame is asked for
+    def __init__(self, width: int = 0, height: int = 0, capacity: int = 0):
+        self.reset(width, height, capacity)
+
+
+    def reset(self, width: int, height: int, capacity: int = 0) -> None:
+        # preallocate when the frame count is known, append grows the array otherwise;
+        # emptied before the swap, a reader on another thread never sees the new array's garbage
+        self._count = 0
+        self._frames = np.empty((capacity, height, width), dtype=np.uint8)
+
+
+    def clear(self) -> None:
+        self._count = 0
+
+
+    @property
+    def frames(self) -> np.ndarray:
+        return self._frames[:self._count]
+
+
+    @property
+    def width(self) -> int:
+        return self._frames.shape[2]
+
+
+    @property
+    def height(self) -> int:
+        return self._frames.shape[1]
+
+
+    def __len__(self) -> int:
+        return self._count
+
+
+    def __getitem__(self, idx: int) -> IndexedImage:
+        if not -self._count <= idx < self._count:
+            raise IndexError('frame index out of range')
+        labels = self._frames[idx % self._count]
+        # built on every call; TRANSPARENT is not a palette index, clear pixels read as index 0
+        opaque = labels != TRANSPARENT
+        return IndexedImage(np.where(opaque, labels, 0), opaque)
+
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
+
+
+    def append(self, image: IndexedImage) -> None:
+        if (image.width, image.height) != (self.width, self.height):
+            if self._count:
+                raise ValueError('Frame size does not match the clip')
+            self.reset(image.width, image.height, len(self._frames))
+
+        if self._count == len(self._frames):
+            grown = np.empty((max(16, self._count * 2), self.height, self.width), dtype=np.uint8)
+            grown[:self._count] = self._frames[:self._count]
+            self._frames = grown
+
+        # the frame is written before it is counted, readers on other threads never see half of it
+        self._frames[self._count] = image.labels()
+        self._count += 1
+
+
+    def repeats(self) -> np.ndarray:
+        # True for every frame identical to the one before it; compared frame by frame,
+        # one compare over the whole clip needs a temporary as large as the clip
+        frames = self.frames
+        same = np.zeros(len(frames), dtype=bool)
+        for idx in range(1, len(frames)):
+            same[idx] = np.array_equal(frames[idx], frames[idx - 1])
+        return same
+
@@ -0,0 +1,184 @@
+import numpy as np
+
+
+PALLETE = {
+    'a': (255, 0, 0),
+    'b': (255, 92, 0),
+    'c': (255, 149, 0),
+    'd': (255, 200, 0),
+    'e': (255, 255, 0),
+    'f': (200, 255, 0),
+    'g': (149, 255, 0),
+    'h': (92, 255, 0),
+    'i': (0, 255, 0),
+    'j': (0, 255, 92),
+    'k': (0, 255, 149),
+    'l': (0, 255, 200),
+    'm': (0, 255, 255),
+    'n': (0, 200, 255),
+    'o': (0, 149, 255),
+    'p': (0, 92, 255),
+    'q': (0, 0, 255),
+    'r': (92, 0, 255),
+    's': (149, 0, 255),
+    't': (200, 0, 255),
+    'u': (255, 0, 255),
+    'v': (255, 0, 200),
+    'w': (255, 0, 149),
+    'x': (255, 0, 92),
+    'y': (255, 255, 255),
+    'z': (172, 172, 255),
+    '9': (149, 149, 149),
+    '0': (0, 0, 0),
+}
+
+COLORS = np.array(list(PALLETE.values()), dtype=np.uint8)
+
+# Bits per channel kept when indexing the RGB -> palette lookup table
+LUT_BITS = 6
+
+_lut = None
+
+
+def build_lut(bits: int = LUT_BITS) -> np.ndarray:
+    size = 1 << bits
+    shift = 8 - bits
+
+    # centre of every cell, so the whole cell maps to its nearest palette colour
+    levels = (np.arange(size, dtype=np.int32) << shift) + ((1 << shift) >> 1)
+    colors = COLORS.astype(np.int32)
+    dist = [(levels[:, None] - colors[:, c]) ** 2 for c in range(3)]
+    dist_gb = dist[1][:, None, :] + dist[2][None, :, :]
+
+    lut = np.empty((size, size, size), dtype=np.uint8)
+    for r in range(size):
+        lut[r] = np.argmin(dist_gb + dist[0][r], axis=-1)
+    return lut.reshape(-1)
+
+
+def get_lut() -> np.ndarray:
+    global _lut
+    if _lut is None:
+        _lut = build_lut(LUT_BITS)
+    return _lut
+
+
+def quantize(rgb: np.ndarray) -> np.ndarray:
+    shift = 8 - LUT_BITS
+    q = rgb[..., :3] >> shift
+    
+    idx = q[..., 0].astype(np.uint32) << (2 * LUT_BITS)
+    idx |= q[..., 1].astype(np.uint32) << LUT_BITS
+    idx |= q[..., 2]
+    return get_lut()[idx]
+
+
+DITHER_MODES = ('none', 'bayer', 'diffusion')
+
+# 4x4 Bayer thresholds centred on zero
+BAYER_4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+]) + 0.5) / 16 - 0.5
+
+# Bayer offset amplitude in RGB units, roughly the distance between neighbouring palette colours
+BAYER_STRENGTH = 96
+
+
+def dither_bayer(rgb: np.ndarray) -> np.ndarray:
+    h, w = rgb.shape[:2]
+    threshold = np.tile(BAYER_4, ((h + 3) // 4, (w + 3) // 4))[:h, :w]
+
+    offset = np.rint(threshold * BAYER_STRENGTH).astype(np.int16)
+    dithered = rgb[..., :3].astype(np.int16) + offset[..., None]
+    return quantize(np.clip(dithered, 0, 255).astype(np.uint8))
+
+
+def dither_diffusion(rgb: np.ndarray, opaque: np.ndarray) -> np.ndarray:
+    # Floyd-Steinberg on anti-diagonal wavefronts: pixel (y, x) only depends on
+    # pixels with a smaller x + 2y, so every pixel of a wavefront is done at once
+    h, w = opaque.shape
+    work = rgb[..., :3].astype(np.float32)
+    colors = COLORS.astype(np.float32)
+    indices = np.zeros((h, w), dtype=np.uint8)
+    all_rows = np.arange(h)
+
+    for t in range(w + 2 * (h - 1)):
+        ys = all_rows[(t - 2 * all_rows >= 0) & (t - 2 * all_rows < w)]
+        xs = t - 2 * ys
+
+        px = np.clip(work[ys, xs], 0, 255)
+        idx = quantize(px.astype(np.uint8))
+        indices[ys, xs] = idx
+
+        # transparent pixels are never shown, so they do not spread any error
+        err = (px - colors[idx]) * opaque[ys, xs, None]
+
+        right = xs + 1 < w
+        work[ys[right], xs[right] + 1] += err[right] * (7 / 16)
+
+        below = ys + 1 < h
+        ys_b, xs_b, err_b = ys[below] + 1, xs[below], err[below]
+        work[ys_b, xs_b] += err_b * (5 / 16)
+        left = xs_b > 0
+        work[ys_b[left], xs_b[left] - 1] += err_b[left] * (3 / 16)
+        right = xs_b + 1 < w
+        work[ys_b[right], xs_b[right] + 1] += err_b[right] * (1 / 16)
+
+    return indices
+
+
+def color_changes(indices: np.ndarray, opaque: np.ndarray) -> np.ndarray:
+    # True where a pixel needs a '^x' code: its colour differs from the last opaque pixel in the row
+    h, w = indices.shape
+
+    # column of the previous opaque pixel in the same row, -1 if none
+    last = np.maximum.accumulate(np.where(opaque, np.arange(w), -1), axis=1)
+    prev = np.full((h, w), -1)
+    prev[:, 1:] = last[:, :-1]
+    prev_idx = np.take_along_axis(indices, np.maximum(prev, 0), axis=1)
+
+    return opaque & ((prev < 0) | (indices != prev_idx))
+
+
+def quantize_rd(rgb: np.ndarray, opaque: np.ndarray, rd_lambda: float) -> np.ndarray:
+    # Viterbi over every row at once: minimise squared colour error plus
+    # rd_lambda for every byte spent on '^x' colour codes (2 per switch)
+    colors = COLORS.astype(np.float32)
+    h, w = opaque.shape
+    rows = np.arange(h)
+    penalty = np.float32(2 * rd_lambda)
+
+    cost = np.zeros((h, len(colors)), dtype=np.float32)
+    switched = np.zeros((h, w, len(colors)), dtype=bool)
+    best_prev = np.zeros((h, w), dtype=np.intp)
+
+    for x in range(w):
+        dist = ((rgb[:, x, None, :3].astype(np.float32) - colors) ** 2).sum(axis=-1)
+
+        best = cost.argmin(axis=1)
+        switch_cost = cost[rows, best] + penalty
+        switch = switch_cost[:, None] < cost
+
+        # transparent pixels print a space and keep the current colour
+        op = opaque[:, x, None]
+        cost = np.where(op, np.where(switch, switch_cost[:, None], cost) + dist, cost)
+        switched[:, x] = switch & op
+        best_prev[:, x] = best
+
+    indices = np.empty((h, w), dtype=np.uint8)
+    state = cost.argmin(axis=1)
+    for x in range(w - 1, -1, -1):
+        indices[:, x] = state
+        state = np.where(switched[rows, x, state], best_prev[:, x], state)
+    return indices
+
+
+def quantization_error(rgb: np.ndarray, indices: np.ndarray, opaque: np.ndarray) -> float:
+    # mean RGB distance between the source and its palette colours over opaque pixels
+    if not opaque.any():
+        return 0.0
+    diff = rgb[..., :3].astype(np.float32) - COLORS[indices].astype(np.float32)
+    return float(np.sqrt((diff ** 2).sum(axis=-1))[opaque].mean())
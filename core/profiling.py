@@ -0,0 +1,74 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# pipeline order, used for display; stages not listed here come last
+STAGES = ('decode', 'cache', 'resize', 'quantize', 'merge', 'encode', 'compress', 'write')
+
+
+def report_path(output_path: str) -> str:
+    # the extension stays, so a clip and a picture with the same name don't collide
+    return output_path + '.profile.json'
+
+
+class Profile:
+    # seconds spent per stage; worker threads add up, so stages can exceed the wall time
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+    def add(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+
+    def totals(self) -> dict[str, tuple[float, int]]:
+        with self._lock:
+            stages = {name: tuple(entry) for name, entry in self.stages.items()}
+        order = {name: i for i, name in enumerate(STAGES)}
+        return dict(sorted(stages.items(), key=lambda item: order.get(item[0], len(order))))
+
+
+    def summary(self, frames: int = 0) -> str:
+        totals = self.totals()
+        busy = sum(seconds for seconds, _ in totals.values()) or 1.0
+
+        parts = [f'{name} {seconds / busy:.0%}' for name, (seconds, _) in totals.items()]
+        if frames:
+            parts.insert(0, f'{frames / max(self.elapsed(), 1e-6):.1f} fps')
+        return '  '.join(parts)
+
+
+    def to_dict(self, frames: int = 0) -> dict:
+        elapsed = self.elapsed()
+        return {
+            'elapsed': elapsed,
+            'frames': frames,
+            'fps': frames / elapsed if frames and elapsed else 0.0,
+            'stages': {name: {'seconds': seconds, 'calls': calls}
+                       for name, (seconds, calls) in self.totals().items()},
+        }
+
+
+    def save(self, path: str, frames: int = 0) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(frames), f, indent=2)
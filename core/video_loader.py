@@ -1,20 +1,80 @@
+import os
+import threading
 import cv2
-from PIL import Image
+import numpy as np
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 from core.image_loader import ImageLoader
+from core.indexed_image import IndexedImage
+from core.indexed_video import IndexedVideo
+from core.profiling import Profile
+from core.frame_cache import FrameCache, shrink, work_size
+
+
+FRAMES_PER_CHUNK = 8
+
+# gaps up to this many frames are grabbed through, longer ones seek
+SEEK_GAP = 64
+
+_worker = threading.local()
+
+
+def process_frame(frame: np.ndarray, width: int, height: int, rd_lambda: float = 0.0,
+                  dither: str = 'none', profile: Profile | None = None) -> tuple[IndexedImage, dict | None]:
+    # every worker thread keeps its own loader, ImageLoader is not thread safe
+    loader = getattr(_worker, 'image_loader', None)
+    if loader is None:
+        loader = _worker.image_loader = ImageLoader()
+    loader.rd_lambda = rd_lambda
+    loader.dither = dither
+
+    # area-average straight from the decoded BGR frame, only the small copy gets converted
+    with profile.stage('resize') if profile else nullcontext():
+        small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+    with profile.stage('quantize') if profile else nullcontext():
+        loader.quantize_array(small)
+    loader.width, loader.height = width, height
+    return loader.indexed, loader.rd_report
+
+
+def _process_chunk(frames: list[np.ndarray], width: int, height: int, rd_lambda: float, dither: str,
+                   profile: Profile) -> list:
+    return [process_frame(frame, width, height, rd_lambda, dither, profile) for frame in frames]
 
 
 class VideoLoader:
-    def __init__(self):
+    def __init__(self, workers: int | None = None, cache_frames: bool = False):
         self.original_video: cv2.VideoCapture | None = None
         self.frame_count = 0
         self.fps = 0
         self.width = 0
         self.height = 0
         
-        self.edited_video: list[Image.Image] = []
+        self.edited_video = IndexedVideo()
+
+        self.rd_lambda = 0.0
+        self.rd_report: dict | None = None
+        self.dither = 'none'
 
-        self.image_loader = ImageLoader()
+        # playback rate and range (seconds) to export, None keeps every frame / runs to the end
+        self.target_fps: float | None = None
+        self.start_time = 0.0
+        self.end_time: float | None = None
+
+        # cv2 releases the GIL while resizing and converting, and so does numpy in quantize, so threads scale
+        self.workers = workers or os.cpu_count() or 1
+
+        # stage timings, swap in a fresh Profile before each run to reset them
+        self.profile = Profile()
+
+        # keep decoded frames on disk so later passes over the clip skip the codec
+        self.cache_frames = cache_frames
+        self.frame_cache: FrameCache | None = None
+        # clip the cache still has to be opened for, done by the first pass over the frames
+        self._cache_source: str | None = None
 
 
     def load_video(self, path: str) -> bool:
@@ -27,30 +87,138 @@ class VideoLoader:
         self.width = int(self.original_video.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.original_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
+        # hashing the file and creating the cache can take a while, it is left to the
+        # processing job instead of holding up whoever opened the clip
+        self.frame_cache = None
+        self._cache_source = path if self.cache_frames and self.frame_count > 0 else None
+
         self.edited_video.clear()
         return True
 
 
-    def process_all_frames(self, width: int, height: int):
+    def output_fps(self) -> float:
+        if self.target_fps and self.fps and self.target_fps < self.fps:
+            return self.target_fps
+        return self.fps
+
+
+    def selected_frames(self) -> np.ndarray:
+        fps = self.fps or 30
+        first = max(0, int(round(self.start_time * fps)))
+        last = self.frame_count
+        if self.end_time is not None:
+            last = min(last, int(round(self.end_time * fps)))
+
+        step = fps / self.output_fps() if self.output_fps() else 1
+        return np.unique(np.floor(np.arange(first, last, step)).astype(np.int64))
+
+
+    def _open_cache(self) -> FrameCache | None:
+        if self._cache_source is not None:
+            path, self._cache_source = self._cache_source, None
+            try:
+                with self.profile.stage('cache'):
+                    self.frame_cache = FrameCache(path, self.frame_count, self.width, self.height)
+            except (OSError, ValueError) as e:
+                print(f'Frame cache disabled: {e}')
+        return self.frame_cache
+
+
+    def _read_chunks(self, chunk_size: int):
+        wanted = self.selected_frames()
+        cache = self._open_cache()
+        pos = None
+
+        chunk = []
+        try:
+            for idx in wanted.tolist():
+                if cache is not None and cache.has(idx):
+                    with self.profile.stage('cache'):
+                        frame = cache.get(idx)
+                else:
+                    with self.profile.stage('decode'):
+                        # seek on the first miss and on long jumps, short gaps are only grabbed,
+                        # which skips the decode
+                        if pos is None or idx < pos or idx - pos > SEEK_GAP:
+                            self.original_video.set(cv2.CAP_PROP_POS_FRAMES, idx)
+                            pos = idx
+                        while pos < idx:
+                            if not self.original_video.grab():
+                                break
+                            pos += 1
+
+                        ret, frame = self.original_video.read()
+                    if not ret:
+                        break
+                    pos += 1
+
+                    if cache is not None:
+                        with self.profile.stage('cache'):
+                            frame = cache.put(idx, frame)
+                    else:
+                        with self.profile.stage('resize'):
+                            frame = shrink(frame, work_size(self.width, self.height))
+
+                chunk.append(frame)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            if cache is not None:
+                cache.flush()
+
+
+    def iter_frames(self, width: int, height: int):
         if self.original_video is None:
             return
 
-        self.edited_video.clear()
-        self.original_video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        self.total_frames = int(self.original_video.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.total_frames = len(self.selected_frames())
+        self.rd_report = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            try:
+                for chunk in self._read_chunks(FRAMES_PER_CHUNK):
+                    pending.append(pool.submit(_process_chunk, chunk, width, height, self.rd_lambda, self.dither,
+                                                self.profile))
+
+                    # keep decoding ahead of the workers, but only a couple of chunks each
+                    if len(pending) > self.workers * 2:
+                        yield from self._finish_chunk(pending.popleft())
+
+                while pending:
+                    yield from self._finish_chunk(pending.popleft())
+            finally:
+                # a closed (cancelled) generator drops the chunks nobody will read
+                for future in pending:
+                    future.cancel()
+
 
-        for i in range(self.total_frames):
-            ret, frame = self.original_video.read()
-            if not ret:
-                break
+    def _finish_chunk(self, future):
+        for frame, report in future.result():
+            if report is not None:
+                self._add_rd_report(report)
+            yield frame
 
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_frame = Image.fromarray(frame_rgb)
 
-            self.image_loader.original_image = pil_frame
-            self.image_loader.resize_image(width, height)
-            self.image_loader.quantize_image()
+    def _add_rd_report(self, report: dict) -> None:
+        # bytes saved add up over the clip, the added error is a per-frame mean
+        if self.rd_report is None:
+            self.rd_report = {'frames': 0, 'bytes_saved': 0, 'error_added': 0.0}
+
+        total = self.rd_report
+        n = total['frames']
+        total['bytes_saved'] += report['bytes_saved']
+        total['error_added'] = (total['error_added'] * n + report['error_added']) / (n + 1)
+        total['frames'] = n + 1
+
+
+    def process_all_frames(self, width: int, height: int):
+        self.edited_video.reset(width, height, len(self.selected_frames()))
 
-            self.edited_video.append(self.image_loader.edited_image.copy())
+        for i, frame in enumerate(self.iter_frames(width, height)):
+            self.edited_video.append(frame)
             
-            yield i + 1
\ No newline at end of file
+            yield i + 1
@@ -0,0 +1,173 @@
+import queue
+import threading
+import tkinter as tk
+from tkinter import ttk, messagebox
+from typing import Callable, Iterable
+
+
+# how often the UI thread picks up progress from the worker
+POLL_MS = 50
+
+
+class Job:
+    def __init__(self, title: str, work: Callable[[], Iterable[int]], total: int,
+                 on_done: Callable[[], None] | None = None,
+                 on_cancel: Callable[[], None] | None = None,
+                 status: Callable[[int], str] | None = None):
+        self.title = title
+        # called on the worker thread, yields the number of finished steps
+        self.work = work
+        self.total = total
+        # both callbacks run on the UI thread; on_cancel also cleans up after a failed job
+        self.on_done = on_done
+        self.on_cancel = on_cancel
+        # extra progress line (speed, stage breakdown), gets the finished step count
+        self.status = status
+
+        self.cancelled = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        # a paused worker has to wake up to notice
+        self.resumed.set()
+
+
+    def toggle_pause(self) -> bool:
+        if self.resumed.is_set():
+            self.resumed.clear()
+            return True
+        self.resumed.set()
+        return False
+
+
+class JobRunner:
+    # one job at a time per owner: the worker thread never touches Tk,
+    # it only puts messages on a queue the UI thread polls with after()
+    def __init__(self, master: tk.Misc):
+        self.master = master
+        self.job: Job | None = None
+        self._queue = queue.Queue()
+
+
+    @property
+    def busy(self) -> bool:
+        return self.job is not None
+
+
+    def ensure_idle(self) -> bool:
+        # overlapping jobs are refused rather than queued, they would fight over the same loader
+        if self.job is None:
+            return True
+        messagebox.showwarning('Busy', f'{self.job.title} is still running.\nCancel it or wait until it is done.')
+        return False
+
+
+    def start(self, job: Job) -> bool:
+        if not self.ensure_idle():
+            return False
+
+        self.job = job
+        self._show_progress(job)
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        self.master.after(POLL_MS, self._poll)
+        return True
+
+
+    def _run(self, job: Job):
+        result = ('done', None)
+        steps = None
+        try:
+            steps = job.work()
+            for step in steps:
+                self._queue.put(('progress', step))
+                job.resumed.wait()
+                if job.cancelled.is_set():
+                    result = ('cancelled', None)
+                    break
+        except Exception as e:
+            result = ('error', e)
+        finally:
+            # closing the generator lets it clean up (close files, stop workers) on this thread
+            close = getattr(steps, 'close', None)
+            if close is not None:
+                close()
+
+        # reported after the close, the UI side may remove what the job was writing
+        self._queue.put(result)
+
+
+    def _poll(self):
+        job = self.job
+        step = None
+        finished = None
+
+        while True:
+            try:
+                kind, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                step = value
+            else:
+                finished = (kind, value)
+
+        if step is not None and not job.cancelled.is_set():
+            self._progress['value'] = step
+            self._label['text'] = f'{job.title}... {step}/{job.total}'
+            if job.status is not None:
+                self._status['text'] = job.status(step)
+
+        if finished is None:
+            self.master.after(POLL_MS, self._poll)
+            return
+
+        self._window.destroy()
+        self.job = None
+
+        kind, value = finished
+        if kind in ('error', 'cancelled'):
+            # a failed job leaves the same half finished output behind as a cancelled one
+            if job.on_cancel is not None:
+                job.on_cancel()
+            if kind == 'error':
+                messagebox.showerror('Error', f'{job.title} failed:\n{value}')
+        elif job.on_done is not None:
+            job.on_done()
+
+
+    def _show_progress(self, job: Job):
+        win = tk.Toplevel(self.master)
+        win.title(job.title)
+        x = self.master.winfo_x() + (self.master.winfo_width() - win.winfo_width()) // 2
+        y = self.master.winfo_y() + (self.master.winfo_height() - win.winfo_height()) // 2
+        win.geometry(f'300x{140 if job.status else 110}+{x}+{y}')
+        win.transient(self.master)
+        win.grab_set()
+
+        self._label = ttk.Label(win, text=f'{job.title}...')
+        self._label.pack(pady=10)
+        self._progress = ttk.Progressbar(win, maximum=max(job.total, 1), length=250, mode='determinate')
+        self._progress.pack(pady=5)
+        self._status = ttk.Label(win, text='', wraplength=280, justify=tk.CENTER)
+        if job.status is not None:
+            self._status.pack()
+
+        buttons = ttk.Frame(win)
+        buttons.pack(pady=5)
+
+        def toggle_pause():
+            btn_pause['text'] = 'Resume' if job.toggle_pause() else 'Pause'
+
+        def cancel():
+            job.cancel()
+            self._label['text'] = 'Cancelling...'
+
+        btn_pause = ttk.Button(buttons, text='Pause', command=toggle_pause)
+        btn_pause.pack(side=tk.LEFT, padx=3)
+        ttk.Button(buttons, text='Cancel', command=cancel).pack(side=tk.LEFT, padx=3)
+        win.protocol('WM_DELETE_WINDOW', cancel)
+
+        self._window = win
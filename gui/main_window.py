@@ -1,10 +1,20 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from threading import Thread
-from PIL import ImageTk, Image
+import os
+import time
 
-from core.video_loader import VideoLoader
+from core.palette import DITHER_MODES
+from core.constants import Q3_FPS, COMPRESS_LEVEL
+from core.profiling import Profile, report_path
 from gui.painter import PainterApp
+from gui.video_preview import PreviewCache
+from gui.jobs import Job, JobRunner
+
+
+def rd_summary(report: dict | None) -> str:
+    if not report:
+        return ''
+    return f"\nColour codes: {report['bytes_saved']} bytes saved, +{report['error_added']:.1f} mean colour error"
 
 
 class MainWindow:
@@ -20,13 +30,30 @@ class MainWindow:
         self.image_frame = ImageFrame(self.notebook)
         self.notebook.add(self.image_frame, text='Image')
 
-        self.image_frame = VideoFrame(self.notebook)
-        self.notebook.add(self.image_frame, text='Video')
+        # the video tab (and OpenCV with it) is only built when it is first opened
+        self.video_tab = ttk.Frame(self.notebook)
+        self.notebook.add(self.video_tab, text='Video')
+        self.video_frame = None
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+
+
+    def on_tab_changed(self, event):
+        if self.video_frame is not None or self.notebook.select() != str(self.video_tab):
+            return
+
+        self.root.config(cursor='watch')
+        self.root.update_idletasks()
+        self.video_frame = VideoFrame(self.video_tab)
+        self.video_frame.pack(expand=True, fill=tk.BOTH)
+        self.root.config(cursor='')
 
 
 class ImageFrame(ttk.Frame):
     def __init__(self, parent):
         super().__init__(parent)
+
+        # encoded rows of earlier exports, re-exporting after a small edit only encodes what changed
+        self.row_cache = None
         
         # -------------- Toolbar --------------
         toolbar = ttk.Frame(self)
@@ -34,6 +61,8 @@ class ImageFrame(ttk.Frame):
 
         ttk.Button(toolbar, text='Open', command=self.open_image).pack(side=tk.LEFT)
         ttk.Button(toolbar, text='Clear', command=self.clear_image).pack(side=tk.LEFT, padx=3)
+        ttk.Button(toolbar, text='Undo', command=lambda: self.painter.undo()).pack(side=tk.LEFT, padx=3)
+        ttk.Button(toolbar, text='Redo', command=lambda: self.painter.redo()).pack(side=tk.LEFT, padx=3)
 
         ttk.Separator(toolbar, orient=tk.VERTICAL).pack(side=tk.LEFT, fill=tk.Y, padx=6)
         self.var_grid = tk.BooleanVar(value=False)
@@ -41,6 +70,10 @@ class ImageFrame(ttk.Frame):
 
         ttk.Button(toolbar, text='Pixel aspect', command=self.fix_pixel_aspect).pack(side=tk.LEFT, padx=3)
 
+        self.var_replace_all = tk.BooleanVar(value=False)
+        ttk.Checkbutton(toolbar, text='Replace all', variable=self.var_replace_all, command=self.toggle_replace_all)\
+            .pack(side=tk.LEFT, padx=3)
+
         # -------------- Main Frame --------------
         main_frame = ttk.Frame(self, padding=10)
         main_frame.pack(fill=tk.BOTH, expand=True)
@@ -64,6 +97,20 @@ class ImageFrame(ttk.Frame):
         ttk.Label(size_spins_box, text='x').pack(side=tk.LEFT, padx=5)
         ttk.Spinbox(size_spins_box, from_=1, to=100, increment=5, textvariable=self.var_height, width=6).pack(side=tk.LEFT)
         
+        # trades a little colour accuracy for fewer colour codes per line
+        rd_frame = ttk.Frame(size_box)
+        rd_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(rd_frame, text='RD λ:').pack(side=tk.LEFT)
+        self.var_rd = tk.DoubleVar(value=0)
+        ttk.Spinbox(rd_frame, from_=0, to=20000, increment=500, textvariable=self.var_rd, width=6).pack(side=tk.LEFT, padx=5)
+
+        dither_frame = ttk.Frame(size_box)
+        dither_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(dither_frame, text='Dither:').pack(side=tk.LEFT)
+        self.var_dither = tk.StringVar(value='none')
+        ttk.Combobox(dither_frame, values=DITHER_MODES, textvariable=self.var_dither, state='readonly', width=9)\
+            .pack(side=tk.LEFT, padx=5)
+        
         ttk.Button(size_box, text='Apply', command=self.resize_image).pack(pady=2, fill=tk.X,)
         
         # -------------- Export Frame --------------
@@ -106,16 +153,19 @@ class ImageFrame(ttk.Frame):
             )
             
         loader = self.painter.loader
+        loader.rd_lambda = self.var_rd.get()
+        loader.dither = self.var_dither.get()
         if not loader.load_image(path, with_alpha=with_alpha):
             messagebox.showerror('Error', 'Failed to load image')
             return
 
         loader.resize_image(self.var_width.get(), self.var_height.get())
+        self.painter.history.clear()
         self.painter.redraw()
         
         
     def fix_pixel_aspect(self):
-        img = self.painter.loader.edited_image
+        img = self.painter.loader.indexed
         if img is None:
             return
 
@@ -144,7 +194,13 @@ class ImageFrame(ttk.Frame):
         self.painter.redraw()
     
     
+    def toggle_replace_all(self):
+        self.painter.replace_all = self.var_replace_all.get()
+
+
     def resize_image(self):
+        self.painter.loader.rd_lambda = self.var_rd.get()
+        self.painter.loader.dither = self.var_dither.get()
         self.painter.resize(self.var_width.get(), self.var_height.get())
         
 
@@ -160,11 +216,13 @@ class ImageFrame(ttk.Frame):
         if not path:
             return
 
-        from core.cfg_writer import CFGWriter
-        writer = CFGWriter(self.painter.loader.edited_image, self.print_method.get())
+        from core.cfg_writer import CFGWriter, RowCache
+        if self.row_cache is None:
+            self.row_cache = RowCache()
+        writer = CFGWriter(self.painter.loader.indexed, self.print_method.get(), cache=self.row_cache)
         writer.save_cfg(path, wait_time=self.var_wait.get())
 
-        messagebox.showinfo('Done', 'CFG file saved')
+        messagebox.showinfo('Done', 'CFG file saved' + rd_summary(self.painter.loader.rd_report))
 
 
 
@@ -172,11 +230,18 @@ class VideoFrame(ttk.Frame):
     def __init__(self, parent):
         super().__init__(parent)
 
+        from core.video_loader import VideoLoader
+
         self.master = parent
-        self.loader = VideoLoader()
+        self.loader = VideoLoader(cache_frames=True)
         self.current_frame = 0
         self.playing = False
         self.tk_frame = None
+        self.preview = PreviewCache()
+        # processing and export share the VideoCapture, so only one job runs at a time
+        self.jobs = JobRunner(self)
+        # perf_counter time at which frame 0 would have been shown
+        self._play_start = 0.0
 
         # -------- Toolbar --------
         toolbar = ttk.Frame(self)
@@ -215,9 +280,37 @@ class VideoFrame(ttk.Frame):
         ttk.Label(size_spins, text='x').pack(side=tk.LEFT, padx=5)
         ttk.Spinbox(size_spins, from_=1, to=100, increment=5, textvariable=self.var_height, width=6).pack(side=tk.LEFT)
 
+        # trades a little colour accuracy for fewer colour codes per line
+        rd_frame = ttk.Frame(size_box)
+        rd_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(rd_frame, text='RD λ:').pack(side=tk.LEFT)
+        self.var_rd = tk.DoubleVar(value=0)
+        ttk.Spinbox(rd_frame, from_=0, to=20000, increment=500, textvariable=self.var_rd, width=6).pack(side=tk.LEFT, padx=5)
+
+        dither_frame = ttk.Frame(size_box)
+        dither_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(dither_frame, text='Dither:').pack(side=tk.LEFT)
+        self.var_dither = tk.StringVar(value='none')
+        ttk.Combobox(dither_frame, values=DITHER_MODES, textvariable=self.var_dither, state='readonly', width=9)\
+            .pack(side=tk.LEFT, padx=5)
+
+        # seconds of the clip to export, an end of 0 runs to the last frame
+        range_frame = ttk.Frame(size_box)
+        range_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(range_frame, text='Range:').pack(side=tk.LEFT)
+        self.var_start = tk.DoubleVar(value=0)
+        self.var_end = tk.DoubleVar(value=0)
+        ttk.Spinbox(range_frame, from_=0, to=36000, textvariable=self.var_start, width=5).pack(side=tk.LEFT, padx=5)
+        ttk.Label(range_frame, text='-').pack(side=tk.LEFT)
+        ttk.Spinbox(range_frame, from_=0, to=36000, textvariable=self.var_end, width=5).pack(side=tk.LEFT, padx=5)
+        
         ttk.Button(size_box, text='Apply', command=self.resize_video)\
             .pack(fill=tk.X, pady=2)
 
+        # without preview frames are only decoded while exporting
+        self.var_preview = tk.BooleanVar(value=True)
+        ttk.Checkbutton(size_box, text='Preview', variable=self.var_preview).pack(anchor=tk.W, pady=2)
+
         # -------- Export box --------
         export_box = ttk.LabelFrame(control_frame, text='Export')
         export_box.pack(fill=tk.X, pady=8)
@@ -229,6 +322,22 @@ class VideoFrame(ttk.Frame):
         self.var_wait = tk.IntVar(value=5)
         ttk.Spinbox(wait_frame, from_=1, to=100, textvariable=self.var_wait, width=6).pack(side=tk.LEFT)
 
+        # frames changing less than this share of pixels are merged into a longer wait
+        merge_frame = ttk.Frame(export_box)
+        merge_frame.pack(fill=tk.X, pady=8)
+
+        ttk.Label(merge_frame, text='Merge %:').pack(side=tk.LEFT, padx=15)
+        self.var_merge = tk.DoubleVar(value=0)
+        ttk.Spinbox(merge_frame, from_=0, to=50, increment=0.5, textvariable=self.var_merge, width=6).pack(side=tk.LEFT)
+
+        # zlib level of the pk3, 0 only stores the files (fast test builds)
+        compress_frame = ttk.Frame(export_box)
+        compress_frame.pack(fill=tk.X, pady=8)
+
+        ttk.Label(compress_frame, text='Compress:').pack(side=tk.LEFT, padx=15)
+        self.var_compress = tk.IntVar(value=COMPRESS_LEVEL)
+        ttk.Spinbox(compress_frame, from_=0, to=9, textvariable=self.var_compress, width=6).pack(side=tk.LEFT)
+
         print_frame = ttk.Frame(export_box)
         print_frame.pack(fill=tk.X, pady=8)
 
@@ -236,6 +345,10 @@ class VideoFrame(ttk.Frame):
         ttk.Radiobutton(print_frame, text='say', value='say', variable=self.print_method).pack(side=tk.LEFT, padx=10)
         ttk.Radiobutton(print_frame, text='echo', value='echo', variable=self.print_method).pack(side=tk.RIGHT, padx=10)
 
+        # stage timings saved as <name>.pk3.profile.json next to the pk3
+        self.var_report = tk.BooleanVar(value=False)
+        ttk.Checkbutton(export_box, text='Profile report', variable=self.var_report).pack(anchor=tk.W, padx=10)
+
         ttk.Button(export_box, text='Create PK3', command=self.export_pk3).pack(fill=tk.X, pady=10)
 
         # -------- Video display --------
@@ -244,6 +357,8 @@ class VideoFrame(ttk.Frame):
 
         
     def open_video(self):
+        if not self.jobs.ensure_idle():
+            return
         path = filedialog.askopenfilename(filetypes=[('Videos', '*.mp4')])
         if not path:
             return
@@ -251,57 +366,82 @@ class VideoFrame(ttk.Frame):
             messagebox.showerror('Error', 'Failed to load video')
             return
 
-        self.process_video()
+        if self.var_preview.get():
+            self.process_video()
     
     
     def clear_video(self):
+        if not self.jobs.ensure_idle():
+            return
         self.playing = False
         self.current_frame = 0
         self.video_canvas.delete('all')
-        self.loader.edited_video = []
-        self.loader.original_video = []
+        self.tk_frame = None
+        self.preview.clear()
+        self.loader.edited_video.clear()
+        # iter_frames and selected_frames see no clip, exporting now writes an empty pack
+        self.loader.original_video = None
+        self.loader.frame_count = 0
+        self.loader.frame_cache = None
     
     
     def process_video(self):
-        progress_win = tk.Toplevel(self.master)
-        progress_win.title('Processing Video')
-        x = self.master.winfo_x() + (self.master.winfo_width() - progress_win.winfo_width()) // 2
-        y = self.master.winfo_y() + (self.master.winfo_height() - progress_win.winfo_height()) // 2
-        progress_win.geometry(f'300x80+{x}+{y}')
-        progress_win.transient(self.master)
-        progress_win.grab_set()
-
-        total_frames = self.loader.frame_count
-        lbl_progress = ttk.Label(progress_win, text='Processing frames...')
-        lbl_progress.pack(pady=10)
-        progress = ttk.Progressbar(progress_win, maximum=total_frames, length=250, mode='determinate')
-        progress.pack(pady=5)
-
-        def start_process_video():
-            progress_gen = self.loader.process_all_frames(self.var_width.get(), self.var_height.get())
-            for step in progress_gen:
-                progress['value'] = step
-                lbl_progress['text'] = f'Processing frames... {step}/{total_frames}'
-                progress_win.update_idletasks()
-
-            progress_win.destroy()
-            messagebox.showinfo('Done', 'Video processed!')
-        
-        Thread(target=start_process_video, daemon=True).start()
+        if not self.jobs.ensure_idle():
+            return
+        self._apply_settings()
+        # the clip is refilled from scratch, playback would show frames as they are overwritten
+        self.playing = False
+        self.preview.clear()
+
+        width, height = self.var_width.get(), self.var_height.get()
+        profile = self.loader.profile = Profile()
+
+        def done():
+            messagebox.showinfo('Done', 'Video processed!' + rd_summary(self.loader.rd_report))
+
+        def cancelled():
+            # a half processed clip would otherwise be exported as the whole one
+            self.playing = False
+            self.loader.edited_video.clear()
+            self.preview.clear()
+
+        self.jobs.start(Job('Processing frames', lambda: self.loader.process_all_frames(width, height),
+                            len(self.loader.selected_frames()), on_done=done, on_cancel=cancelled,
+                            status=profile.summary))
+
+
+    def _apply_settings(self):
+        self.loader.rd_lambda = self.var_rd.get()
+        self.loader.dither = self.var_dither.get()
+
+        # only decode as many frames as the game plays back at this wait
+        self.loader.target_fps = Q3_FPS / max(self.var_wait.get(), 1)
+        self.loader.start_time = self.var_start.get()
+        self.loader.end_time = self.var_end.get() or None
         
-    
-    def show_frame(self, idx):        
-        frame = self.loader.edited_video[idx]
+
+    def show_frame(self, idx):
         canvas_w = self.video_canvas.winfo_width()
         canvas_h = self.video_canvas.winfo_height()
-        frame_resized = frame.resize((canvas_w, canvas_h), Image.NEAREST)
-        self.tk_frame = ImageTk.PhotoImage(frame_resized)
-        self.video_canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_frame)
-    
+        if canvas_w <= 1 or canvas_h <= 1 or idx >= len(self.loader.edited_video):
+            return
+
+        # one PhotoImage and one canvas item, recreated only when the canvas is resized
+        if self.tk_frame is None or (self.tk_frame.width(), self.tk_frame.height()) != (canvas_w, canvas_h):
+            self.tk_frame = tk.PhotoImage(width=canvas_w, height=canvas_h)
+            self.video_canvas.delete('all')
+            self.video_canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_frame)
+
+        self.preview.set_source(self.loader.edited_video, canvas_w, canvas_h)
+        self.tk_frame.put(self.preview.get(idx))
+        self.preview.prefetch(idx + 1)
+
 
     def play_video(self):
-        if not self.playing:
+        if not self.playing and self.loader.edited_video:
             self.playing = True
+            fps = self.loader.output_fps() or 30
+            self._play_start = time.perf_counter() - self.current_frame / fps
             self._play_loop()
 
 
@@ -309,13 +449,19 @@ class VideoFrame(ttk.Frame):
         if not self.playing:
             return
 
+        count = len(self.loader.edited_video)
+        if not count:
+            self.playing = False
+            return
+
+        # the frame is picked from the clock, late ticks skip frames instead of slowing down
+        fps = self.loader.output_fps() or 30
+        tick = int((time.perf_counter() - self._play_start) * fps)
+        self.current_frame = tick % count
         self.show_frame(self.current_frame)
-        self.current_frame += 1
-        if self.current_frame >= len(self.loader.edited_video):
-            self.current_frame = 0
 
-        fps = self.loader.fps or 30
-        self.after(int(1000 / fps), self._play_loop)
+        delay = (tick + 1) / fps - (time.perf_counter() - self._play_start)
+        self.after(max(1, int(delay * 1000)), self._play_loop)
 
 
     def pause_video(self):
@@ -330,12 +476,19 @@ class VideoFrame(ttk.Frame):
 
 
     def resize_video(self):
+        if not self.jobs.ensure_idle():
+            return
         if self.loader.original_video is None:
             return
+        if not self.var_preview.get():
+            self.loader.edited_video.clear()
+            return
         self.process_video()
         
         
     def export_pk3(self):
+        if not self.jobs.ensure_idle():
+            return
         path = filedialog.asksaveasfilename(
             defaultextension='.pk3',
             filetypes=[('PK3 files', '*.pk3')]
@@ -343,30 +496,39 @@ class VideoFrame(ttk.Frame):
         if not path:
             return
         
-        progress_win = tk.Toplevel(self.master)
-        progress_win.title('Creating pk3 file')
-        x = self.master.winfo_x() + (self.master.winfo_width() - progress_win.winfo_width()) // 2
-        y = self.master.winfo_y() + (self.master.winfo_height() - progress_win.winfo_height()) // 2
-        progress_win.geometry(f'300x80+{x}+{y}')
-        progress_win.transient(self.master)
-        progress_win.grab_set()
-
-        total_frames = self.loader.frame_count
-        lbl_progress = ttk.Label(progress_win, text='Processing frames...')
-        lbl_progress.pack(pady=10)
-        progress = ttk.Progressbar(progress_win, maximum=total_frames, length=250, mode='determinate')
-        progress.pack(pady=5)
-
         from core.cfg_writer import PK3Writer
-        writer = PK3Writer(self.loader.edited_video, self.print_method.get(), self.var_wait.get())
-        def start_process_video():
-            progress_gen = writer.save_pk3(path)
-            for step in progress_gen:
-                progress['value'] = step
-                lbl_progress['text'] = f'Processing frames... {step}/{total_frames}'
-                progress_win.update_idletasks()
-
-            progress_win.destroy()
-            messagebox.showinfo('Done', 'PK3 file saved!')
-        
-        Thread(target=start_process_video, daemon=True).start()
\ No newline at end of file
+        # one profile for decoding and writing when the frames are streamed
+        profile = self.loader.profile = Profile()
+        if self.var_preview.get() and self.loader.edited_video:
+            frames = self.loader.edited_video
+            total_frames = len(frames)
+        else:
+            self._apply_settings()
+            frames = self.loader.iter_frames(self.var_width.get(), self.var_height.get())
+            total_frames = len(self.loader.selected_frames())
+
+        writer = PK3Writer(frames, self.print_method.get(), self.var_wait.get(),
+                           merge_threshold=self.var_merge.get() / 100, profile=profile,
+                           compress_level=self.var_compress.get())
+        save_report = self.var_report.get()
+
+        def work():
+            try:
+                yield from writer.save_pk3(path)
+            finally:
+                # stop the decoder and its workers along with the writer
+                close = getattr(frames, 'close', None)
+                if close is not None:
+                    close()
+
+        def done():
+            if save_report:
+                profile.save(report_path(path), frames=total_frames)
+            messagebox.showinfo('Done', 'PK3 file saved!' + rd_summary(self.loader.rd_report))
+
+        def cancelled():
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.jobs.start(Job('Creating pk3 file', work, total_frames, on_done=done, on_cancel=cancelled,
+                            status=profile.summary))
@@ -1,14 +1,18 @@
 import tkinter as tk
 from tkinter import ttk
-from PIL import Image, ImageTk, ImageDraw
+import numpy as np
+from PIL import Image
 
 from core.image_loader import ImageLoader, PALLETE
+from core.edit_history import EditHistory
+from core.indexed_image import TRANSPARENT
+from core.palette import COLORS
 
 
 class PainterApp:
     def __init__(self, parent, width: int = 60, height: int = 40):
         self.parent = parent
-        self.current_color = (0, 0, 0)
+        self.current_color = list(PALLETE).index('0')
 
         self.loader = ImageLoader(width, height)
 
@@ -18,19 +22,34 @@ class PainterApp:
         self.canvas = tk.Canvas(self.canvas_frame, bg='white')
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
-        self.canvas.bind('<Button-1>', self.on_brush)
+        self.canvas.bind('<Button-1>', self.on_press)
         self.canvas.bind('<B1-Motion>', self.on_brush)
+        self.canvas.bind('<ButtonRelease-1>', self.on_release)
         self.canvas.bind('<Button-3>', self.on_fill)
         self.canvas.bind('<Configure>', lambda e: self.redraw())
 
+        self.history = EditHistory()
+        root = self.parent.winfo_toplevel()
+        root.bind('<Control-z>', lambda e: self.undo())
+        root.bind('<Control-y>', lambda e: self.redo())
+        root.bind('<Control-Z>', lambda e: self.redo())
+
         self.palette_frame = ttk.Frame(self.parent)
         self.palette_frame.pack(fill=tk.X)
         self._create_palette_buttons()
 
         self.show_grid = False
+        # right click recolours every pixel of the clicked colour instead of one area
+        self.replace_all = False
         self.scale_x = 1
         self.scale_y = 1
         self.tk_image = None
+
+        # (canvas w, canvas h, image w, image h) the photo image and grid were built for
+        self._layout = None
+        self._checker = None
+        self._col_src = None
+        self._row_src = None
         
         self.redraw()
 
@@ -47,29 +66,24 @@ class PainterApp:
         btn.pack(side=tk.LEFT, padx=1)
         self.palette_buttons[None] = btn
         
-        for _, rgb in PALLETE.items():
+        for idx, rgb in enumerate(PALLETE.values()):
             btn = tk.Button(
                 self.palette_frame,
                 bg='#%02x%02x%02x' % rgb,
                 width=2,
-                command=lambda c=rgb: self.set_color(c)
+                command=lambda c=idx: self.set_color(c)
             )
             btn.pack(side=tk.LEFT, padx=1, pady=1)
-            self.palette_buttons[rgb] = btn
+            self.palette_buttons[idx] = btn
             
         self.active_button = None
         self.set_color(self.current_color)
 
 
     def _make_checkerboard(self, w, h, size=10):
-        img = Image.new('RGB', (w, h), (200, 200, 200))
-        d = ImageDraw.Draw(img)
-
-        for y in range(0, h, size):
-            for x in range(0, w, size):
-                if (x // size + y // size) % 2 == 0:
-                    d.rectangle([x, y, x+size, y+size], fill=(240, 240, 240))
-        return img
+        light = (np.arange(h)[:, None] // size + np.arange(w)[None, :] // size) % 2 == 0
+        shade = np.where(light, np.uint8(240), np.uint8(200))
+        return np.repeat(shade[:, :, None], 3, axis=2)
     
     
     def set_color(self, color):
@@ -87,97 +101,123 @@ class PainterApp:
     def set_image(self, pil_image: Image.Image):
         self.loader.original_image = pil_image.copy()
         self.loader.resize_image(self.loader.width, self.loader.height)
+        self.history.clear()
         self.redraw()
         
 
     def resize(self, width: int, height: int):
         self.loader.resize_image(width, height)
+        self.history.clear()
         self.redraw()
 
 
     def clear(self, width: int, height: int):
         self.loader = ImageLoader(width, height)
+        self.history.clear()
         self.redraw()
 
     
     def flood_fill(self, start_x, start_y, new_color):
-        self.loader.edited_image = self.loader.edited_image.copy()
+        img = self.loader.indexed
+        labels = img.labels()
 
-        img = self.loader.edited_image
-        pixels = img.load()
+        target_label = labels[start_y, start_x]
+        new_label = TRANSPARENT if new_color is None else new_color
 
-        w, h = img.size
-        target_color = pixels[start_x, start_y]
+        if target_label == new_label:
+            return None
 
-        if target_color == new_color:
-            return
+        region = labels == target_label
+        if not self.replace_all:
+            # scipy takes a quarter second to import, only the first fill pays for it
+            from scipy import ndimage
 
-        stack = [(start_x, start_y)]
+            # 4-connected component under the cursor
+            components, _ = ndimage.label(region)
+            region = components == components[start_y, start_x]
 
-        while stack:
-            x, y = stack.pop()
+        self.history.record(img, *np.nonzero(region))
+        img.paint(region, new_color)
 
-            if x < 0 or y < 0 or x >= w or y >= h:
-                continue
+        ys, xs = np.nonzero(region)
+        return int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
 
-            if pixels[x, y] != target_color:
-                continue
 
-            pixels[x, y] = new_color
+    def _event_pixel(self, event):
+        px = int(event.x / self.scale_x)
+        py = int(event.y / self.scale_y)
+
+        if not (0 <= px < self.loader.width and 0 <= py < self.loader.height):
+            return None
+        return px, py
 
-            stack.append((x + 1, y))
-            stack.append((x - 1, y))
-            stack.append((x, y + 1))
-            stack.append((x, y - 1))
+
+    def on_press(self, event):
+        self.history.begin()
+        self.on_brush(event)
+
+
+    def on_release(self, event):
+        if self.loader.indexed is not None:
+            self.history.commit(self.loader.indexed)
 
 
     def on_brush(self, event):
-        img = self.loader.edited_image
+        img = self.loader.indexed
         if img is None:
             return
 
-        px = int(event.x / self.scale_x)
-        py = int(event.y / self.scale_y)
-
-        if not (0 <= px < self.loader.width and 0 <= py < self.loader.height):
+        pixel = self._event_pixel(event)
+        if pixel is None:
             return
 
-        # цвет
+        px, py = pixel
         if self.current_color is None:
-            color = (0, 0, 0, 0)
+            unchanged = not img.opaque[py, px]
         else:
-            color = (*self.current_color, 255)
-
-        self.loader.edited_image = img.copy()
+            unchanged = img.opaque[py, px] and img.indices[py, px] == self.current_color
+        if unchanged:
+            return
 
-        self.loader.edited_image.putpixel((px, py), color)
-        self.redraw()
+        self.history.record(img, py, px)
+        img.paint((py, px), self.current_color)
+        self.redraw(dirty=(px, py, px + 1, py + 1))
     
     
     def on_fill(self, event):
-        img = self.loader.edited_image
-        if img is None:
+        if self.loader.indexed is None:
             return
 
-        px = int(event.x / self.scale_x)
-        py = int(event.y / self.scale_y)
-
-        if not (0 <= px < self.loader.width and 0 <= py < self.loader.height):
+        pixel = self._event_pixel(event)
+        if pixel is None:
             return
 
-        if self.current_color is None:
-            color = (0, 0, 0, 0)
-        else:
-            color = (*self.current_color, 255)
+        self.history.begin()
+        dirty = self.flood_fill(*pixel, self.current_color)
+        self.history.commit(self.loader.indexed)
+        if dirty is not None:
+            self.redraw(dirty=dirty)
 
-        self.loader.edited_image = img.copy()
 
-        self.flood_fill(px, py, color)
-        self.redraw()
+    def undo(self):
+        if self.loader.indexed is None:
+            return
+        dirty = self.history.undo(self.loader.indexed)
+        if dirty is not None:
+            self.redraw(dirty=dirty)
+
+
+    def redo(self):
+        if self.loader.indexed is None:
+            return
+        dirty = self.history.redo(self.loader.indexed)
+        if dirty is not None:
+            self.redraw(dirty=dirty)
 
 
-    def redraw(self):
-        img = self.loader.edited_image
+    def redraw(self, dirty=None):
+        # dirty is the (x0, y0, x1, y1) pixel box that changed, None repaints everything
+        img = self.loader.indexed
         if img is None:
             return
 
@@ -186,33 +226,66 @@ class PainterApp:
         if cw <= 1 or ch <= 1:
             return
 
-        self.scale_x = cw / img.width
-        self.scale_y = ch / img.height
+        layout = (cw, ch, img.width, img.height)
+        if layout != self._layout:
+            self._build_layout(*layout)
+            dirty = None
 
-        new_size = (int(img.width * self.scale_x), int(img.height * self.scale_y))
-        
-        checker = self._make_checkerboard(*new_size)
-        scaled_img = img.resize(new_size, Image.NEAREST)
-        
-        composed = checker.convert('RGBA')
-        composed.alpha_composite(scaled_img)
+        self.canvas.itemconfigure('grid', state=tk.NORMAL if self.show_grid else tk.HIDDEN)
+
+        if dirty is None:
+            self._render(0, 0, cw, ch)
+        else:
+            x0, y0, x1, y1 = dirty
+            cx0, cx1 = np.searchsorted(self._col_src, (x0, x1))
+            cy0, cy1 = np.searchsorted(self._row_src, (y0, y1))
+            self._render(int(cx0), int(cy0), int(cx1), int(cy1))
+
+
+    def _build_layout(self, cw, ch, w, h):
+        self.scale_x = cw / w
+        self.scale_y = ch / h
+
+        # source pixel of every canvas column and row, the same mapping as a NEAREST resize
+        self._col_src = np.minimum(((np.arange(cw) + 0.5) * w / cw).astype(np.intp), w - 1)
+        self._row_src = np.minimum(((np.arange(ch) + 0.5) * h / ch).astype(np.intp), h - 1)
+
+        if self._checker is None or self._checker.shape[:2] != (ch, cw):
+            self._checker = self._make_checkerboard(cw, ch)
 
-        self.tk_image = ImageTk.PhotoImage(composed)
+        self.tk_image = tk.PhotoImage(width=cw, height=ch)
 
         self.canvas.delete('all')
         self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_image)
-        
-        if self.show_grid:
-            for x in range(img.width + 1):
-                self.canvas.create_line(
-                    x * self.scale_x, 0,
-                    x * self.scale_x, new_size[1],
-                    fill='gray'
-                )
-
-            for y in range(img.height + 1):
-                self.canvas.create_line(
-                    0, y * self.scale_y,
-                    new_size[0], y * self.scale_y,
-                    fill='gray'
-                )
+
+        for x in range(w + 1):
+            self.canvas.create_line(
+                x * self.scale_x, 0,
+                x * self.scale_x, ch,
+                fill='gray', tags='grid'
+            )
+
+        for y in range(h + 1):
+            self.canvas.create_line(
+                0, y * self.scale_y,
+                cw, y * self.scale_y,
+                fill='gray', tags='grid'
+            )
+
+        self._layout = (cw, ch, w, h)
+
+
+    def _render(self, cx0, cy0, cx1, cy1):
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+
+        img = self.loader.indexed
+        rows = self._row_src[cy0:cy1, None]
+        cols = self._col_src[None, cx0:cx1]
+
+        opaque = img.opaque[rows, cols]
+        rgb = np.where(opaque[:, :, None], COLORS[img.indices[rows, cols]], self._checker[cy0:cy1, cx0:cx1])
+
+        # raw PPM lets Tk blit the block straight into the existing photo image
+        header = f'P6 {cx1 - cx0} {cy1 - cy0} 255\n'.encode()
+        self.tk_image.put(header + rgb.tobytes(), to=(cx0, cy0))
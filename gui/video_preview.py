@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from core.indexed_image import IndexedImage
+from core.palette import COLORS
+
+
+def render_frame(frame: IndexedImage, width: int, height: int) -> bytes:
+    # NEAREST upscale straight to PPM, transparent pixels show the black canvas
+    rows = np.minimum(((np.arange(height) + 0.5) * frame.height / height).astype(np.intp), frame.height - 1)
+    cols = np.minimum(((np.arange(width) + 0.5) * frame.width / width).astype(np.intp), frame.width - 1)
+
+    rgb = COLORS[frame.indices[rows[:, None], cols[None, :]]]
+    rgb[~frame.opaque[rows[:, None], cols[None, :]]] = 0
+    return f'P6 {width} {height} 255\n'.encode() + rgb.tobytes()
+
+
+class PreviewCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ahead: int = 8):
+        self.max_bytes = max_bytes
+        # frames rendered ahead of the one on screen
+        self.ahead = ahead
+
+        self.frames: list[IndexedImage] = []
+        self.size = (0, 0)
+
+        self._cache = OrderedDict()
+        self._bytes = 0
+        # bumped on every clear so late renders for old settings are dropped
+        self._generation = 0
+        self._wanted = []
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+            self._wanted = []
+            self._generation += 1
+
+
+    def set_source(self, frames: list[IndexedImage], width: int, height: int) -> None:
+        if frames is self.frames and (width, height) == self.size:
+            return
+        self.clear()
+        with self._lock:
+            self.frames = frames
+            self.size = (width, height)
+
+
+    def get(self, idx: int) -> bytes:
+        with self._lock:
+            data = self._cache.get(idx)
+            if data is not None:
+                self._cache.move_to_end(idx)
+                return data
+            frame, size, generation = self.frames[idx], self.size, self._generation
+
+        data = render_frame(frame, *size)
+        self._store(idx, data, generation)
+        return data
+
+
+    def prefetch(self, idx: int) -> None:
+        with self._wake:
+            count = len(self.frames)
+            self._wanted = [(idx + i) % count for i in range(min(self.ahead, count))]
+            self._wake.notify()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+
+    def _worker(self):
+        while True:
+            with self._wake:
+                while not self._wanted:
+                    self._wake.wait()
+
+                idx = self._wanted.pop(0)
+                if idx in self._cache or idx >= len(self.frames):
+                    continue
+                frame, size, generation = self.frames[idx], self.size, self._generation
+
+            self._store(idx, render_frame(frame, *size), generation)
+
+
+    def _store(self, idx: int, data: bytes, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation or idx in self._cache:
+                return
+
+            self._cache[idx] = data
+            self._bytes += len(data)
+
+            # least recently shown frames go first, the newest one always stays
+            while self._bytes > self.max_bytes and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._bytes -= len(old)
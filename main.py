@@ -1,8 +1,15 @@
-import tkinter as tk
-from gui.main_window import MainWindow
+import sys
 
 
 if __name__ == "__main__":
+    # any arguments run the headless batch converter, tkinter is never imported
+    if len(sys.argv) > 1:
+        from core.batch import main
+        sys.exit(main(sys.argv[1:]))
+
+    import tkinter as tk
+    from gui.main_window import MainWindow
+
     root = tk.Tk()
     app = MainWindow(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()